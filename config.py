@@ -35,4 +35,17 @@ class Config:
 
     # 转换时使用的高质量 FFmpeg (pydub) 参数
     # 'soxr' 提供了高质量的重采样 (resampling)
-    FLAC_HQ_FFMPEG_PARAMS = ['-af', 'aresample=resampler=soxr:precision=28:dither_method=triangular_hp']
\ No newline at end of file
+    FLAC_HQ_FFMPEG_PARAMS = ['-af', 'aresample=resampler=soxr:precision=28:dither_method=triangular_hp']
+
+    # 上传时计算音频指纹，用于发现不同格式、标签或转换前后的同一首歌
+    FINGERPRINT_ENABLED = True
+
+    # 指纹相似度达到此值 (0~1) 即视为近似重复
+    NEAR_DUPLICATE_THRESHOLD = 0.25
+
+    # 同时计算指纹的最大任务数，限制批量上传时的 CPU 与内存占用
+    FINGERPRINT_MAX_WORKERS = 2
+
+    # 如果为True，近似重复的文件将像完全相同的文件一样被拒绝上传；
+    # 为 False 时仅提示，可在“疑似重复”报告中人工处理。
+    FINGERPRINT_REJECT_NEAR_DUPLICATES = False
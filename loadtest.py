@@ -0,0 +1,620 @@
+# loadtest.py
+"""
+网络音乐机负载测试工具。
+
+在临时目录中用 create_app 启动一个独立的服务进程（临时数据库 + 临时上传目录），
+然后模拟以下负载并按场景输出报告：
+  * 浏览器客户端：连接 Socket.IO，打开 /index/，收到曲库变更后按前端逻辑刷新列表；
+  * 我的世界客户端：流式下载 /music/<file>，并随机发起 Range 请求模拟拖动进度；
+  * 管理员：定期批量上传 (/upload) 并删除 (/delete/batch) 音乐。
+
+报告包含吞吐量、p50/p95/p99 延迟、事件送达延迟（服务端发出到客户端收到，
+event_*）、上传处理耗时（upload_processed），以及服务进程的 CPU 与内存占用。
+全部在本机离线运行，仅支持 Linux（通过 /proc 采样服务进程）。
+
+依赖：
+    pip install "python-socketio[client]"   # 附带 requests 与 websocket-client
+    测试音频由 pydub + FFmpeg 生成，也可以用 --audio-dir 指定现有的 MP3/FLAC 文件。
+
+用法：
+    python loadtest.py --browsers 50 --streamers 20 --duration 60
+    python loadtest.py --scenario stream --streamers 100 --server gunicorn
+"""
+import argparse
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+ADMIN_USERNAME = 'loadtest'
+ADMIN_PASSWORD = 'loadtest-password'
+
+SCENARIOS = ['browse', 'stream', 'burst', 'mixed']
+
+CSRF_PATTERN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+
+# --- 服务端 ---
+
+def create_loadtest_app():
+    """
+    以临时目录为数据目录创建应用，并初始化数据库和管理员账户。
+    工作目录与临时 SECRET_KEY 通过环境变量传入（见 start_server），gunicorn 也可直接调用此函数。
+    """
+    workdir = os.environ['NETMUSIC_LOADTEST_DIR']
+
+    from config import Config
+    from webapp import create_app
+    from webapp.extensions import db
+    from webapp.models import User
+    from webapp.suggest import suggestion_index
+
+    class LoadTestConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(workdir, 'music.db')
+        UPLOAD_FOLDER = os.path.join(workdir, 'uploads')
+
+    app = create_app(LoadTestConfig)
+    with app.app_context():
+        db.create_all()
+        if not User.query.first():
+            admin_user = User(username=ADMIN_USERNAME, is_admin=True)
+            admin_user.set_password(ADMIN_PASSWORD)
+            db.session.add(admin_user)
+            db.session.commit()
+        suggestion_index.rebuild()
+    return app
+
+
+def serve(port):
+    from webapp.extensions import socketio
+    app = create_loadtest_app()
+    socketio.run(app, host='127.0.0.1', port=port, allow_unsafe_werkzeug=True, log_output=False)
+
+
+def start_server(server, port, workdir):
+    env = dict(os.environ, NETMUSIC_LOADTEST_DIR=workdir)
+    # config.Config 在导入时即要求 SECRET_KEY，必须在服务进程导入 webapp 之前设置
+    env.setdefault('SECRET_KEY', uuid.uuid4().hex)
+    root = os.path.dirname(os.path.abspath(__file__))
+    if server == 'gunicorn':
+        # 与 Dockerfile 中的生产启动方式一致
+        cmd = ['gunicorn', '--worker-class', 'eventlet', '-w', '1',
+               '--bind', f'127.0.0.1:{port}', 'loadtest:create_loadtest_app()']
+    else:
+        cmd = [sys.executable, os.path.abspath(__file__), '--serve', '--port', str(port)]
+    log = open(os.path.join(workdir, 'server.log'), 'wb')
+    return subprocess.Popen(cmd, cwd=root, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_for_server(base_url, proc, timeout=30):
+    import requests
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('服务进程启动失败，请查看临时目录中的 server.log')
+        try:
+            requests.get(base_url + '/login', timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError('等待服务启动超时')
+
+
+# --- 统计 ---
+
+def percentile(sorted_values, pct):
+    """最近秩法计算百分位数"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class Stats:
+    """线程安全的延迟与计数统计"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.bytes = {}
+
+    def record(self, name, seconds, ok=True, nbytes=0):
+        with self._lock:
+            if ok:
+                self.latencies.setdefault(name, []).append(seconds)
+            else:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            if nbytes:
+                self.bytes[name] = self.bytes.get(name, 0) + nbytes
+
+    def summary(self, elapsed):
+        with self._lock:
+            names = sorted(set(self.latencies) | set(self.errors))
+            result = {}
+            for name in names:
+                values = sorted(self.latencies.get(name, []))
+                result[name] = {
+                    'count': len(values),
+                    'errors': self.errors.get(name, 0),
+                    'per_sec': len(values) / elapsed if elapsed else 0.0,
+                    'mb_per_sec': self.bytes.get(name, 0) / elapsed / 1e6 if elapsed else 0.0,
+                    'p50_ms': _ms(percentile(values, 50)),
+                    'p95_ms': _ms(percentile(values, 95)),
+                    'p99_ms': _ms(percentile(values, 99)),
+                }
+            return result
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+class ProcessSampler(threading.Thread):
+    """通过 /proc 采样服务进程（含子进程）的 CPU 时间与常驻内存"""
+
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.peak_rss = 0
+        self.rss_samples = []
+
+    def _pids(self):
+        pids = [self.pid]
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open(f'/proc/{entry}/stat') as f:
+                        fields = f.read().rsplit(')', 1)[1].split()
+                    if int(fields[1]) == self.pid:
+                        pids.append(int(entry))
+                except (OSError, IndexError, ValueError):
+                    continue
+        return pids
+
+    def cpu_seconds(self):
+        total = 0
+        for pid in self._pids():
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                total += int(fields[11]) + int(fields[12])  # utime + stime
+            except (OSError, IndexError, ValueError):
+                continue
+        return total / self._clock_ticks
+
+    def rss_bytes(self):
+        total = 0
+        for pid in self._pids():
+            try:
+                with open(f'/proc/{pid}/status') as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1]) * 1024
+                            break
+            except (OSError, ValueError):
+                continue
+        return total
+
+    def reset(self):
+        self.peak_rss = 0
+        self.rss_samples = []
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            rss = self.rss_bytes()
+            self.rss_samples.append(rss)
+            self.peak_rss = max(self.peak_rss, rss)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+# --- 测试音频 ---
+
+class AudioSource:
+    """提供内容互不相同的测试音频，避免被服务端的去重逻辑跳过"""
+
+    def __init__(self, audio_dir=None, seconds=20):
+        self.files = []
+        if audio_dir:
+            for name in sorted(os.listdir(audio_dir)):
+                if name.lower().endswith(('.mp3', '.flac')):
+                    with open(os.path.join(audio_dir, name), 'rb') as f:
+                        self.files.append((name, f.read()))
+            if not self.files:
+                raise RuntimeError(f'{audio_dir} 中没有 MP3/FLAC 文件')
+        self.seconds = seconds
+
+    def make(self, index):
+        """返回 (文件名, 内容)"""
+        if self.files:
+            name, content = self.files[index % len(self.files)]
+            if index < len(self.files):
+                return name, content
+            # 重复使用现有文件时，在尾部追加随机字节以得到不同的MD5
+            return name, content + uuid.uuid4().bytes
+
+        from pydub.generators import Sine
+        fmt = 'flac' if index % 4 == 0 else 'mp3'
+        tone = Sine(random.uniform(220, 880)).to_audio_segment(duration=self.seconds * 1000)
+        buffer = io.BytesIO()
+        tone.export(buffer, format=fmt, tags={'title': uuid.uuid4().hex})
+        return f'负载测试 Track {index:05d}.{fmt}', buffer.getvalue()
+
+
+# --- 客户端 ---
+
+def delivery_lag(data):
+    """
+    事件送达延迟：收到时间减去服务端在事件中记录的发送时间 (emitted_at)。
+    服务与客户端运行在同一台机器上，可直接比较时钟；上传处理耗时另见 upload_processed。
+    """
+    emitted_at = data.get('emitted_at') if isinstance(data, dict) else None
+    return None if emitted_at is None else max(0.0, time.time() - emitted_at)
+
+
+class BrowserClient:
+    """模拟访问 /index/ 的浏览器：Socket.IO 长连接 + 收到变更后刷新列表"""
+
+    def __init__(self, base_url, stats, browse_interval):
+        import requests
+        import socketio
+        self.base_url = base_url
+        self.stats = stats
+        self.browse_interval = browse_interval
+        self.http = requests.Session()
+        self.sio = socketio.Client(http_session=self.http, reconnection=False)
+        self.sio.on('music_added', self._on_music_added)
+        self.sio.on('remove_music_items_batch', self._on_music_removed)
+        self.sio.on('upload_status', self._on_leaked_event)
+        self.sio.on('upload_progress', self._on_leaked_event)
+
+    def _get(self, name, path, **kwargs):
+        start = time.monotonic()
+        try:
+            response = self.http.get(self.base_url + path, timeout=30, **kwargs)
+            self.stats.record(name, time.monotonic() - start, response.ok, len(response.content))
+        except Exception:
+            self.stats.record(name, time.monotonic() - start, ok=False)
+
+    def _refresh_list(self):
+        self._get('index_xhr', '/index/', headers={'X-Requested-With': 'XMLHttpRequest'})
+
+    def _on_music_added(self, data):
+        lag = delivery_lag(data)
+        if lag is not None:
+            self.stats.record('event_music_added', lag)
+        self._refresh_list()
+
+    def _on_music_removed(self, data):
+        lag = delivery_lag(data)
+        if lag is not None:
+            self.stats.record('event_music_removed', lag)
+        self._refresh_list()
+
+    def _on_leaked_event(self, data):
+        # 公共访客不应收到管理员上传消息
+        self.stats.record('leaked_admin_event', 0, ok=False)
+
+    def run(self, stop_event):
+        self._get('index_page', '/index/')
+        start = time.monotonic()
+        try:
+            self.sio.connect(self.base_url, transports=['websocket'])
+            self.stats.record('socket_connect', time.monotonic() - start)
+        except Exception:
+            self.stats.record('socket_connect', time.monotonic() - start, ok=False)
+            return
+
+        words = ['a', 'b', 'fu', 'zai', 'track', 'la']
+        while not stop_event.wait(random.uniform(0.5, 1.5) * self.browse_interval):
+            if random.random() < 0.5:
+                self._get('suggest', '/suggest', params={'q': random.choice(words)})
+            else:
+                self._get('index_xhr', '/index/', headers={'X-Requested-With': 'XMLHttpRequest'},
+                          params={'page': random.randint(1, 3), 'q': random.choice(['', '', 'track'])})
+        self.sio.disconnect()
+
+
+class StreamClient:
+    """模拟网络音乐机模组：顺序读取音乐文件，并随机拖动进度 (Range 请求)"""
+
+    def __init__(self, base_url, stats, upload_dir, chunk_size=64 * 1024):
+        import requests
+        self.base_url = base_url
+        self.stats = stats
+        self.upload_dir = upload_dir
+        self.chunk_size = chunk_size
+        self.http = requests.Session()
+
+    def _pick_file(self):
+        try:
+            names = os.listdir(self.upload_dir)
+        except OSError:
+            return None
+        return random.choice(names) if names else None
+
+    def _fetch(self, name, url, headers=None, max_bytes=None):
+        start = time.monotonic()
+        received = 0
+        try:
+            with self.http.get(url, headers=headers, stream=True, timeout=30) as response:
+                if response.status_code not in (200, 206):
+                    self.stats.record(name, time.monotonic() - start, ok=False)
+                    return None
+                first_byte = None
+                for chunk in response.iter_content(self.chunk_size):
+                    if first_byte is None:
+                        first_byte = time.monotonic() - start
+                    received += len(chunk)
+                    if max_bytes and received >= max_bytes:
+                        break
+                self.stats.record(name, first_byte or time.monotonic() - start, nbytes=received)
+                self.stats.record(name + '_total', time.monotonic() - start)
+                return int(response.headers.get('Content-Length', received))
+        except Exception:
+            self.stats.record(name, time.monotonic() - start, ok=False)
+            return None
+
+    def run(self, stop_event):
+        while not stop_event.is_set():
+            filename = self._pick_file()
+            if not filename:
+                stop_event.wait(0.5)
+                continue
+            url = f'{self.base_url}/music/{filename}'
+            size = self._fetch('stream', url, max_bytes=512 * 1024)
+            if size and not stop_event.is_set():
+                offset = random.randint(0, max(0, size - 1))
+                self._fetch('range_seek', url, headers={'Range': f'bytes={offset}-'}, max_bytes=256 * 1024)
+
+
+class AdminClient:
+    """管理员：登录后批量上传、批量删除"""
+
+    def __init__(self, base_url, stats, audio):
+        import requests
+        import socketio
+        self.base_url = base_url
+        self.stats = stats
+        self.audio = audio
+        self.http = requests.Session()
+        self.csrf_token = None
+        self.sio = socketio.Client(http_session=self.http, reconnection=False)
+        self.sio.on('music_added', self._on_music_added)
+        self.sio.on('upload_progress', self._on_upload_progress)
+        self._lock = threading.Lock()
+        self._known_ids = []
+        self._pending_uploads = set()
+        self._upload_started = {}
+        self._file_index = 0
+
+    def login(self):
+        page = self.http.get(self.base_url + '/login', timeout=30).text
+        token = CSRF_PATTERN.search(page).group(1)
+        self.http.post(self.base_url + '/login', data={
+            'csrf_token': token, 'username': ADMIN_USERNAME, 'password': ADMIN_PASSWORD
+        }, timeout=30)
+        page = self.http.get(self.base_url + '/admin/', timeout=30).text
+        match = CSRF_PATTERN.search(page)
+        if not match:
+            raise RuntimeError('管理员登录失败')
+        self.csrf_token = match.group(1)
+        self.sio.connect(self.base_url, transports=['websocket'])
+
+    def _on_music_added(self, data):
+        with self._lock:
+            self._known_ids.extend(data.get('new_ids', []))
+
+    def _on_upload_progress(self, data):
+        now = time.monotonic()
+        for item in data.get('items', []):
+            if item['stage'] in ('saved', 'duplicate', 'failed'):
+                with self._lock:
+                    started = self._upload_started.pop(item['upload_id'], None)
+                    self._pending_uploads.discard(item['upload_id'])
+                if started is not None:
+                    self.stats.record('upload_processed', now - started, ok=item['stage'] == 'saved')
+            elif item['stage'] == 'received':
+                with self._lock:
+                    self._pending_uploads.add(item['upload_id'])
+                    self._upload_started[item['upload_id']] = now
+
+    def pending_uploads(self):
+        with self._lock:
+            return len(self._pending_uploads)
+
+    def upload_burst(self, count):
+        files = []
+        for _ in range(count):
+            name, content = self.audio.make(self._file_index)
+            self._file_index += 1
+            mimetype = 'audio/flac' if name.endswith('.flac') else 'audio/mpeg'
+            files.append(('file', (name, content, mimetype)))
+
+        start = time.monotonic()
+        try:
+            response = self.http.post(self.base_url + '/upload', files=files,
+                                      headers={'X-CSRFToken': self.csrf_token}, timeout=120)
+            ok = response.ok and response.json().get('success', False)
+            self.stats.record('upload_request', time.monotonic() - start, ok,
+                              sum(len(f[1][1]) for f in files))
+        except Exception:
+            self.stats.record('upload_request', time.monotonic() - start, ok=False)
+
+    def delete_burst(self, count):
+        with self._lock:
+            ids, self._known_ids = self._known_ids[:count], self._known_ids[count:]
+        if not ids:
+            return
+        start = time.monotonic()
+        try:
+            response = self.http.post(self.base_url + '/delete/batch',
+                                      json={'music_ids': ids, 'current_page': 1},
+                                      headers={'X-CSRF-Token': self.csrf_token}, timeout=60)
+            self.stats.record('delete_request', time.monotonic() - start, response.status_code == 200)
+        except Exception:
+            self.stats.record('delete_request', time.monotonic() - start, ok=False)
+
+    def run(self, stop_event, interval, burst_size):
+        while not stop_event.is_set():
+            self.upload_burst(burst_size)
+            if stop_event.wait(interval / 2):
+                break
+            self.delete_burst(burst_size // 2)
+            stop_event.wait(interval / 2)
+
+    def seed(self, count, timeout=300):
+        """预先上传一批音乐，供浏览和流式场景使用"""
+        for start in range(0, count, 10):
+            self.upload_burst(min(10, count - start))
+        deadline = time.monotonic() + timeout
+        time.sleep(0.5)
+        while self.pending_uploads() and time.monotonic() < deadline:
+            time.sleep(0.2)
+
+
+# --- 场景 ---
+
+def run_scenario(name, args, base_url, upload_dir, sampler, admin):
+    stats = Stats()
+    admin.stats = stats
+    stop_event = threading.Event()
+    threads = []
+
+    browsers = args.browsers if name in ('browse', 'burst', 'mixed') else 0
+    streamers = args.streamers if name in ('stream', 'mixed') else 0
+    bursts = name in ('burst', 'mixed')
+
+    for _ in range(browsers):
+        client = BrowserClient(base_url, stats, args.browse_interval)
+        threads.append(threading.Thread(target=client.run, args=(stop_event,), daemon=True))
+    for _ in range(streamers):
+        client = StreamClient(base_url, stats, upload_dir)
+        threads.append(threading.Thread(target=client.run, args=(stop_event,), daemon=True))
+    if bursts:
+        threads.append(threading.Thread(target=admin.run, args=(stop_event, args.burst_interval, args.burst_size),
+                                        daemon=True))
+
+    sampler.reset()
+    cpu_before = sampler.cpu_seconds()
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    stop_event.wait(args.duration)
+    stop_event.set()
+    for thread in threads:
+        thread.join(timeout=30)
+    elapsed = time.monotonic() - started
+    cpu_used = sampler.cpu_seconds() - cpu_before
+
+    rss = sampler.rss_samples or [sampler.rss_bytes()]
+    return {
+        'scenario': name,
+        'browsers': browsers,
+        'streamers': streamers,
+        'bursts': bursts,
+        'duration_s': round(elapsed, 2),
+        'server_cpu_percent': round(cpu_used / elapsed * 100, 1) if elapsed else 0.0,
+        'server_rss_mb_avg': round(sum(rss) / len(rss) / 1e6, 1),
+        'server_rss_mb_peak': round(max(sampler.peak_rss, max(rss)) / 1e6, 1),
+        'metrics': stats.summary(elapsed),
+    }
+
+
+def print_report(report):
+    print(f"\n=== 场景 {report['scenario']}: 浏览器 {report['browsers']} / 流式 {report['streamers']} / "
+          f"管理员批量操作 {'开' if report['bursts'] else '关'} / {report['duration_s']} 秒 ===")
+    print(f"服务进程 CPU {report['server_cpu_percent']}%  "
+          f"内存 平均 {report['server_rss_mb_avg']} MB / 峰值 {report['server_rss_mb_peak']} MB")
+    header = f"{'指标':<22}{'次数':>8}{'错误':>7}{'次/秒':>9}{'MB/秒':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    print(header)
+    print('-' * len(header))
+    for name, m in report['metrics'].items():
+        print(f"{name:<22}{m['count']:>8}{m['errors']:>7}{m['per_sec']:>9.1f}{m['mb_per_sec']:>8.2f}"
+              f"{_fmt(m['p50_ms']):>10}{_fmt(m['p95_ms']):>10}{_fmt(m['p99_ms']):>10}")
+
+
+def _fmt(value):
+    return '-' if value is None else f'{value:.1f}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='网络音乐机负载测试工具')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=33550, help='测试服务监听端口')
+    parser.add_argument('--server', choices=['werkzeug', 'gunicorn'], default='werkzeug',
+                        help='服务启动方式，gunicorn 与 Docker 部署一致')
+    parser.add_argument('--scenario', choices=SCENARIOS + ['all'], default='all', help='要运行的场景')
+    parser.add_argument('--browsers', type=int, default=20, help='并发浏览器客户端数 (N)')
+    parser.add_argument('--streamers', type=int, default=10, help='并发流式客户端数 (M)')
+    parser.add_argument('--duration', type=float, default=30, help='每个场景的持续秒数')
+    parser.add_argument('--seed', type=int, default=20, help='开始前预先上传的音乐数量')
+    parser.add_argument('--burst-size', type=int, default=10, help='每次批量上传的文件数')
+    parser.add_argument('--burst-interval', type=float, default=10, help='批量上传/删除的间隔秒数')
+    parser.add_argument('--browse-interval', type=float, default=5, help='浏览器客户端搜索/翻页的平均间隔秒数')
+    parser.add_argument('--audio-dir', help='使用该目录中的 MP3/FLAC 作为测试音频')
+    parser.add_argument('--audio-seconds', type=int, default=20, help='生成的测试音频时长')
+    parser.add_argument('--json', dest='json_path', help='将报告另存为 JSON 文件')
+    parser.add_argument('--keep', action='store_true', help='保留临时目录（数据库、上传文件与服务日志）')
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='netmusic-loadtest-')
+    upload_dir = os.path.join(workdir, 'uploads')
+    base_url = f'http://127.0.0.1:{args.port}'
+    proc = start_server(args.server, args.port, workdir)
+    sampler = None
+    try:
+        wait_for_server(base_url, proc)
+        sampler = ProcessSampler(proc.pid)
+        sampler.start()
+
+        audio = AudioSource(args.audio_dir, args.audio_seconds)
+        admin = AdminClient(base_url, Stats(), audio)
+        admin.login()
+        print(f'正在预先上传 {args.seed} 首测试音乐...')
+        admin.seed(args.seed)
+
+        scenarios = SCENARIOS if args.scenario == 'all' else [args.scenario]
+        reports = []
+        for name in scenarios:
+            report = run_scenario(name, args, base_url, upload_dir, sampler, admin)
+            print_report(report)
+            reports.append(report)
+
+        if args.json_path:
+            with open(args.json_path, 'w', encoding='utf-8') as f:
+                json.dump(reports, f, ensure_ascii=False, indent=2)
+    finally:
+        if sampler:
+            sampler.stop()
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        if args.keep:
+            print(f'临时目录已保留: {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,18 @@ load_dotenv()
 
 from webapp import create_app
 from webapp.extensions import db, socketio
+from webapp.suggest import suggestion_index
+from webapp.fingerprint import fingerprint_index
+from webapp.models import upgrade_schema
 
 app = create_app()
 
 def init_db():
     with app.app_context():
         db.create_all()
+        upgrade_schema()
+        suggestion_index.rebuild()
+        fingerprint_index.rebuild()
 
 init_db()
 
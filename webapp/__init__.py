@@ -1,10 +1,14 @@
 # webapp/__init__.py
-from flask import Flask, render_template
+from flask import Flask, render_template, session
 from config import Config
 from .extensions import db, login_manager, socketio, csrf
-from .models import User
+from .auth import load_cached_user
 from datetime import timedelta
 import os
+import time
+
+# 长期会话的续期间隔（秒）：距上次续期超过该时间才重新下发 Cookie
+SESSION_RENEW_INTERVAL = 24 * 60 * 60
 
 def create_app(config_class=Config):
     app = Flask(__name__, instance_relative_config=False,
@@ -14,7 +18,7 @@ def create_app(config_class=Config):
     app.jinja_env.add_extension('jinja2.ext.do')
     app.config.from_object(config_class)
     app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
-    app.config['SESSION_REFRESH_EACH_REQUEST'] = True
+    app.config['SESSION_REFRESH_EACH_REQUEST'] = False
 
     if not os.path.exists(os.path.join(app.root_path, '..', 'instance')):
         os.makedirs(os.path.join(app.root_path, '..', 'instance'))
@@ -33,7 +37,7 @@ def create_app(config_class=Config):
 
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return load_cached_user(int(user_id))
 
     # 注册蓝图
     from .auth import auth_bp
@@ -42,6 +46,21 @@ def create_app(config_class=Config):
     from .main import main_bp
     app.register_blueprint(main_bp)
 
+    # 注册 Socket.IO 事件处理
+    from . import events  # noqa: F401
+
+    # 注册命令行工具
+    from .fingerprint import fingerprint_backfill_command
+    app.cli.add_command(fingerprint_backfill_command)
+
+    @app.before_request
+    def renew_permanent_session():
+        """“记住我”的会话每天续期一次，保持 7 天滑动过期，而不必每个请求都重新签发 Cookie"""
+        if session.permanent:
+            now = int(time.time())
+            if now - session.get('_renewed_at', 0) >= SESSION_RENEW_INTERVAL:
+                session['_renewed_at'] = now
+
     @app.errorhandler(404)
     def not_found_error(error):
         return render_template('404.html'), 404
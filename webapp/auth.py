@@ -6,10 +6,57 @@ from wtforms import StringField, PasswordField, SubmitField, BooleanField
 from wtforms.validators import DataRequired, Length, EqualTo, ValidationError, Regexp
 from flask_wtf import FlaskForm
 from datetime import datetime, timedelta
+import threading
+import time
 
 auth_bp = Blueprint('auth', __name__)
 
 
+# --- 请求快速路径 ---
+
+# 管理员账户一旦创建便不会被删除，确认后无需每次请求都查询数据库
+_setup_complete = False
+
+# 已登录用户的短时缓存: {user_id: (user, 过期时间)}
+IDENTITY_CACHE_TTL = 60
+_identity_cache = {}
+_identity_lock = threading.Lock()
+
+
+def is_setup_complete():
+    """是否已创建管理员账户"""
+    global _setup_complete
+    if not _setup_complete:
+        _setup_complete = db.session.query(User.id).first() is not None
+    return _setup_complete
+
+
+def load_cached_user(user_id):
+    """
+    为 user_loader 提供带缓存的用户加载。
+    缓存的是已脱离会话的对象，修改用户信息时需重新查询并调用 invalidate_cached_user。
+    """
+    now = time.monotonic()
+    with _identity_lock:
+        cached = _identity_cache.get(user_id)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    if user.is_admin:
+        db.session.expunge(user)
+        with _identity_lock:
+            _identity_cache[user_id] = (user, now + IDENTITY_CACHE_TTL)
+    return user
+
+
+def invalidate_cached_user(user_id):
+    with _identity_lock:
+        _identity_cache.pop(user_id, None)
+
+
 # --- 表单类 ---
 class SetupForm(FlaskForm):
     username = StringField('管理员用户名', validators=[
@@ -70,7 +117,7 @@ class ChangePasswordForm(FlaskForm):
 
 @auth_bp.route('/setup', methods=['GET', 'POST'])
 def setup():
-    if User.query.first():
+    if is_setup_complete():
         flash('管理员账户已存在，请直接登录。', 'info')
         return redirect(url_for('auth.login'))
 
@@ -80,6 +127,8 @@ def setup():
         admin_user.set_password(form.password.data)
         db.session.add(admin_user)
         db.session.commit()
+        global _setup_complete
+        _setup_complete = True
 
         flash('创建成功！请使用刚才设置的账户进行登录。', 'success')
         return redirect(url_for('auth.login'))
@@ -89,7 +138,7 @@ def setup():
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
-    if not User.query.first():
+    if not is_setup_complete():
         return redirect(url_for('auth.setup'))
     if current_user.is_authenticated:
         return redirect(url_for('main.admin'))
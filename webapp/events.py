@@ -0,0 +1,101 @@
+# webapp/events.py
+from flask import current_app
+from flask_login import current_user
+from flask_socketio import join_room
+from .extensions import socketio
+from .models import Music
+import threading
+import time
+
+# --- Socket.IO 房间 ---
+ADMIN_ROOM = 'admins'
+PUBLIC_ROOM = 'public'
+
+# 曲库变更事件的合并窗口（秒）
+LIBRARY_EVENT_WINDOW = 0.5
+
+
+def uploader_room(user_id):
+    """每个上传者独立的房间，用于推送仅与其相关的上传状态"""
+    return f'user_{user_id}'
+
+
+@socketio.on('connect')
+def handle_connect(auth=None):
+    """按身份将连接分配到对应房间"""
+    if current_user.is_authenticated and current_user.is_admin:
+        join_room(ADMIN_ROOM)
+        join_room(uploader_room(current_user.id))
+    else:
+        join_room(PUBLIC_ROOM)
+
+
+def emit_upload_status(user_id, message, category):
+    """向上传者推送上传结果提示"""
+    socketio.emit('upload_status', {'message': message, 'category': category},
+                  to=uploader_room(user_id))
+
+
+def emit_upload_progress(user_id, items):
+    """
+    向上传者推送上传进度。
+    items: [{'upload_id': ..., 'filename': ..., 'stage': ...}]
+    stage 取值: received / normalizing / hashing / saved / duplicate / failed
+    """
+    socketio.emit('upload_progress', {'items': items}, to=uploader_room(user_id))
+
+
+class LibraryEventBatcher:
+    """将短时间内的曲库变更合并为一次广播，减少批量上传/删除时的推送量"""
+
+    def __init__(self, window=LIBRARY_EVENT_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._added_ids = []
+        self._removed_ids = []
+        self._scheduled = False
+        self._app = None
+
+    def music_added(self, music_id):
+        with self._lock:
+            self._added_ids.append(music_id)
+            self._schedule_locked()
+
+    def music_removed(self, music_ids):
+        with self._lock:
+            self._removed_ids.extend(music_ids)
+            self._schedule_locked()
+
+    def _schedule_locked(self):
+        # 调用方均处于应用上下文中，记录 app 以便合并发送时查询最新总数
+        self._app = current_app._get_current_object()
+        if not self._scheduled:
+            self._scheduled = True
+            socketio.start_background_task(self._flush_later)
+
+    def _flush_later(self):
+        socketio.sleep(self.window)
+        with self._lock:
+            removed_ids = self._removed_ids
+            removed_set = set(removed_ids)
+            added_ids = [music_id for music_id in self._added_ids if music_id not in removed_set]
+            app = self._app
+            self._added_ids = []
+            self._removed_ids = []
+            self._scheduled = False
+
+        if removed_ids:
+            # 同一窗口内可能还有新增，发送时重新统计总数
+            with app.app_context():
+                total_count_after = Music.query.count()
+            socketio.emit('remove_music_items_batch', {
+                'music_ids': removed_ids,
+                'total_music_count_after': total_count_after,
+                'emitted_at': time.time()
+            })
+        if added_ids:
+            # emitted_at 为服务端发送时间，供负载测试统计事件送达延迟
+            socketio.emit('music_added', {'new_ids': added_ids, 'emitted_at': time.time()})
+
+
+library_events = LibraryEventBatcher()
@@ -0,0 +1,447 @@
+# webapp/fingerprint.py
+from flask import current_app
+from flask.cli import with_appcontext
+from pydub import AudioSegment
+import numpy as np
+import subprocess
+import threading
+import click
+import os
+
+from .extensions import db
+from .models import Music
+
+# --- 指纹参数 ---
+# 解码为单声道低采样率后计算频谱，只保留旋律主体所在的频段
+SAMPLE_RATE = 8000
+MAX_SECONDS = 180
+FRAME_SIZE = 1024
+HOP_SIZE = 512
+# 在多个起始偏移上分帧，使前后静音或裁剪带来的帧错位不超过 HOP_SIZE / FRAME_OFFSETS
+FRAME_OFFSETS = 4
+STFT_BLOCK_FRAMES = 256
+
+# 频谱峰值：在 (±PEAK_NEIGHBOR_FRAMES 帧, ±PEAK_NEIGHBOR_BINS 频点) 范围内为最大值
+PEAK_NEIGHBOR_FRAMES = 3
+PEAK_NEIGHBOR_BINS = 8
+PEAK_MIN_LOG_RATIO = 2.0
+
+# 每个锚点与其后 FAN_OUT 个峰值两两组合为三元组，时间跨度 2~32 帧（约 0.1~2 秒），
+# 以覆盖和弦进行与旋律走向，而不仅仅是当前和弦
+FAN_OUT = 6
+MIN_DELTA_FRAMES = 2
+MAX_DELTA_FRAMES = 32
+
+# MinHash 签名长度与 LSH 分段：48 段 × 每段 2 个值（每段拼成一个 64 位整数作为分段键）
+NUM_PERM = 96
+LSH_BANDS = 48
+LSH_ROWS = NUM_PERM // LSH_BANDS
+
+# 增量同步时每次从数据库读取的指纹数量
+SYNC_BATCH_SIZE = 500
+
+# 同时计算指纹的最大任务数，限制批量上传时的 CPU 与内存占用
+DEFAULT_MAX_WORKERS = 2
+
+_MERSENNE_PRIME = np.uint64((1 << 31) - 1)
+_rng = np.random.RandomState(20240601)  # 固定种子，保证签名在不同进程间一致
+_PERM_A = _rng.randint(1, (1 << 31) - 1, size=NUM_PERM).astype(np.uint64)
+_PERM_B = _rng.randint(0, (1 << 31) - 1, size=NUM_PERM).astype(np.uint64)
+
+_worker_slots = None
+_worker_slots_lock = threading.Lock()
+
+
+def _spectral_peaks(samples):
+    """计算频谱，返回局部最大峰值的 (帧序号, 量化频点)"""
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME_SIZE)[::HOP_SIZE]
+    window = np.hanning(FRAME_SIZE).astype(np.float32)
+    spectrum = np.empty((len(frames), FRAME_SIZE // 2 + 1), dtype=np.float32)
+    for start in range(0, len(frames), STFT_BLOCK_FRAMES):  # 分块计算，限制临时数组大小
+        block = frames[start:start + STFT_BLOCK_FRAMES] * window
+        spectrum[start:start + len(block)] = np.log1p(np.abs(np.fft.rfft(block, axis=1)))
+    spectrum[:, :4] = 0  # 忽略直流和极低频
+
+    # 可分离的二维最大值滤波：先沿时间，再沿频率
+    padded = np.pad(spectrum, ((PEAK_NEIGHBOR_FRAMES, PEAK_NEIGHBOR_FRAMES), (0, 0)), constant_values=-1)
+    local_max = np.lib.stride_tricks.sliding_window_view(padded, 2 * PEAK_NEIGHBOR_FRAMES + 1, axis=0).max(axis=2)
+    padded = np.pad(local_max, ((0, 0), (PEAK_NEIGHBOR_BINS, PEAK_NEIGHBOR_BINS)), constant_values=-1)
+    local_max = np.lib.stride_tricks.sliding_window_view(padded, 2 * PEAK_NEIGHBOR_BINS + 1, axis=1).max(axis=2)
+
+    threshold = np.median(spectrum, axis=1, keepdims=True) + PEAK_MIN_LOG_RATIO
+    times, bins = np.nonzero((spectrum == local_max) & (spectrum > threshold))
+    return times.astype(np.int64), (bins // 2).astype(np.uint64)  # 频率量化，容忍有损编码的误差
+
+
+def _peak_triplet_hashes(samples):
+    """将每个峰值与其后的两个峰值组合为 (f0, f1, f2, dt1, dt2) 哈希"""
+    if len(samples) < FRAME_SIZE:
+        return np.empty(0, dtype=np.uint64)
+
+    times, bins = _spectral_peaks(samples)
+    count = len(times)
+    hashes = []
+    for k1 in range(1, FAN_OUT):
+        for k2 in range(k1 + 1, FAN_OUT + 1):
+            if count <= k2:
+                continue
+            n = count - k2
+            dt1 = times[k1:k1 + n] - times[:n]
+            dt2 = times[k2:] - times[:n]
+            valid = (dt1 >= MIN_DELTA_FRAMES) & (dt2 <= MAX_DELTA_FRAMES) & (dt1 < dt2)
+            triplet = ((bins[:n] << np.uint64(34)) | (bins[k1:k1 + n] << np.uint64(26)) |
+                       (bins[k2:] << np.uint64(18)) | (dt1.astype(np.uint64) << np.uint64(9)) |
+                       dt2.astype(np.uint64))
+            hashes.append(triplet[valid])
+    if not hashes:
+        return np.empty(0, dtype=np.uint64)
+    return np.unique(np.concatenate(hashes))
+
+
+def _minhash(hashes):
+    """计算哈希集合的 MinHash 签名（逐个置换计算，避免大块临时数组）"""
+    values = hashes % _MERSENNE_PRIME
+    signature = np.empty(NUM_PERM, dtype=np.uint32)
+    for i in range(NUM_PERM):
+        signature[i] = ((_PERM_A[i] * values + _PERM_B[i]) % _MERSENNE_PRIME).min()
+    return signature
+
+
+def fingerprint_from_samples(samples):
+    """由单声道采样 (SAMPLE_RATE) 计算指纹签名，无有效峰值时返回 None"""
+    samples = np.asarray(samples, dtype=np.float32)[:SAMPLE_RATE * MAX_SECONDS]
+    offsets = [offset * HOP_SIZE // FRAME_OFFSETS for offset in range(FRAME_OFFSETS)]
+    hashes = np.unique(np.concatenate([_peak_triplet_hashes(samples[offset:]) for offset in offsets]))
+    if hashes.size == 0:
+        return None
+    return _minhash(hashes)
+
+
+def _decode_samples(file_content, file_ext):
+    """用 FFmpeg 只解码前 MAX_SECONDS 秒，并直接输出单声道 SAMPLE_RATE 的 16 位 PCM"""
+    command = [AudioSegment.converter, '-v', 'error', '-f', file_ext.lstrip('.'), '-i', 'pipe:0',
+               '-t', str(MAX_SECONDS), '-ac', '1', '-ar', str(SAMPLE_RATE), '-f', 's16le', 'pipe:1']
+    result = subprocess.run(command, input=file_content, capture_output=True, timeout=120)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode('utf-8', 'replace').strip())
+    return np.frombuffer(result.stdout, dtype='<i2')
+
+
+def _get_worker_slots():
+    global _worker_slots
+    with _worker_slots_lock:
+        if _worker_slots is None:
+            _worker_slots = threading.BoundedSemaphore(
+                current_app.config.get('FINGERPRINT_MAX_WORKERS', DEFAULT_MAX_WORKERS))
+        return _worker_slots
+
+
+def _run_in_os_thread(func, *args):
+    """
+    在系统线程中执行 CPU 密集的计算。
+    以 gunicorn eventlet worker 运行时线程已被替换为协程，直接计算会阻塞所有请求与推送，需交给 eventlet 的线程池。
+    """
+    try:
+        from eventlet import patcher, tpool
+    except ImportError:
+        return func(*args)
+    if patcher.is_monkey_patched('thread'):
+        return tpool.execute(func, *args)
+    return func(*args)
+
+
+def compute_fingerprint(file_content, file_ext):
+    """解码音频内容并计算指纹，返回可存入数据库的 bytes，失败时返回 None"""
+    try:
+        # 信号量限制同时计算的任务数；FFmpeg 解码本身在子进程中，只有频谱计算放入系统线程
+        with _get_worker_slots():
+            samples = _decode_samples(file_content, file_ext)
+            signature = _run_in_os_thread(fingerprint_from_samples, samples)
+    except Exception as e:
+        current_app.logger.error(f"计算音频指纹失败: {str(e)}")
+        return None
+    return None if signature is None else signature.astype('<u4').tobytes()
+
+
+def _to_signature(fingerprint):
+    return np.frombuffer(fingerprint, dtype='<u4').astype(np.uint32)
+
+
+class FingerprintIndex:
+    """
+    基于 MinHash + LSH 分段的近似重复检索索引。
+    同一分段完全相同的音乐成为候选，再按签名一致比例估算相似度。
+    绝大多数分段只有一首音乐，此时直接存放其 ID，出现冲突后才改用 set，以减少重建耗时和内存。
+    除已入库的音乐外，也登记正在上传中的指纹（以上传标识为键），使同批上传的同一首歌能互相发现。
+    """
+
+    def __init__(self):
+        self._buckets = [{} for _ in range(LSH_BANDS)]
+        self._signatures = {}
+        self._pending = {}  # 上传标识 -> 文件名
+        self._lock = threading.Lock()
+        self._built = False
+
+    @staticmethod
+    def _band_keys(signature):
+        return signature.view(np.uint64).tolist()
+
+    @staticmethod
+    def _members(bucket):
+        if bucket is None:
+            return ()
+        return bucket if isinstance(bucket, set) else (bucket,)
+
+    @staticmethod
+    def _build(rows):
+        music_ids = [music_id for music_id, _ in rows]
+        signatures = {music_id: _to_signature(fingerprint) for music_id, fingerprint in rows}
+        if not rows:
+            return [{} for _ in range(LSH_BANDS)], signatures
+
+        # 按列向量化构建：先整体写入单值分段，再把键重复的分段改为 set
+        matrix = np.stack([signatures[music_id] for music_id in music_ids]).view(np.uint64)
+        buckets = []
+        for column in matrix.T:
+            band = dict(zip(column.tolist(), music_ids))
+            _, inverse, counts = np.unique(column, return_inverse=True, return_counts=True)
+            shared_rows = np.flatnonzero(counts[inverse] > 1).tolist()
+            shared_keys = column[shared_rows].tolist()
+            for key in shared_keys:
+                band[key] = set()
+            for key, row in zip(shared_keys, shared_rows):
+                band[key].add(music_ids[row])
+            buckets.append(band)
+        return buckets, signatures
+
+    def rebuild(self):
+        """从数据库全量重建索引（需要应用上下文），新结构在锁外构建后再替换"""
+        rows = Music.query.with_entities(Music.id, Music.fingerprint).filter(Music.fingerprint.isnot(None)).all()
+        # 十万级曲库构建需数秒，放到系统线程中以免阻塞 eventlet 的其他请求
+        buckets, signatures = _run_in_os_thread(self._build, rows)
+
+        with self._lock:
+            pending = [(token, self._signatures[token]) for token in self._pending]
+            self._buckets = buckets
+            self._signatures = signatures
+            for token, signature in pending:
+                self._add_locked(token, signature)
+            self._built = True
+
+    def _ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    def sync(self):
+        """
+        与数据库增量同步（如其他进程运行了补全命令、删除后尚未移出索引）：
+        只加载索引中缺少的指纹，并移除数据库中已不存在的音乐。
+        """
+        if not self._built:
+            self.rebuild()
+            return
+
+        # 先取索引快照再查数据库：快照中的 ID 均已提交，查不到即说明已被删除
+        with self._lock:
+            indexed_ids = {key for key in self._signatures if key not in self._pending}
+        stored_ids = {music_id for (music_id,) in
+                      Music.query.with_entities(Music.id).filter(Music.fingerprint.isnot(None)).all()}
+        missing_ids = stored_ids - indexed_ids
+        gone_ids = indexed_ids - stored_ids
+        if not missing_ids and not gone_ids:
+            return
+
+        loaded = []
+        missing_ids = sorted(missing_ids)
+        for start in range(0, len(missing_ids), SYNC_BATCH_SIZE):
+            batch = missing_ids[start:start + SYNC_BATCH_SIZE]
+            rows = Music.query.with_entities(Music.id, Music.fingerprint).filter(
+                Music.id.in_(batch), Music.fingerprint.isnot(None)).all()
+            loaded.extend((music_id, _to_signature(fingerprint)) for music_id, fingerprint in rows)
+
+        with self._lock:
+            for music_id in gone_ids:
+                self._remove_locked(music_id)
+            for music_id, signature in loaded:
+                if music_id not in self._signatures:
+                    self._add_locked(music_id, signature)
+
+    def _add_locked(self, music_id, signature):
+        self._signatures[music_id] = signature
+        for band, key in zip(self._buckets, self._band_keys(signature)):
+            bucket = band.get(key)
+            if bucket is None:
+                band[key] = music_id
+            elif isinstance(bucket, set):
+                bucket.add(music_id)
+            elif bucket != music_id:
+                band[key] = {bucket, music_id}
+
+    def _remove_locked(self, music_id):
+        signature = self._signatures.pop(music_id, None)
+        if signature is None:
+            return
+        for band, key in zip(self._buckets, self._band_keys(signature)):
+            bucket = band.get(key)
+            if isinstance(bucket, set):
+                bucket.discard(music_id)
+                if len(bucket) == 1:
+                    band[key] = bucket.pop()
+            elif bucket == music_id:
+                del band[key]
+
+    def add(self, music_id, fingerprint):
+        if fingerprint is None:
+            return
+        with self._lock:
+            self._remove_locked(music_id)
+            self._add_locked(music_id, _to_signature(fingerprint))
+
+    def remove(self, music_id):
+        with self._lock:
+            self._remove_locked(music_id)
+
+    def query(self, fingerprint, threshold, exclude_id=None):
+        """
+        返回相似度不低于 threshold 的 [(key, similarity)]，按相似度降序。
+        key 为 Music ID（int），或正在上传中的音乐的上传标识（str）。
+        """
+        if fingerprint is None:
+            return []
+        self._ensure_built()
+        signature = _to_signature(fingerprint)
+        with self._lock:
+            return self._query_locked(signature, threshold, exclude_id)
+
+    def _query_locked(self, signature, threshold, exclude_id=None):
+        candidates = set()
+        for band, key in zip(self._buckets, self._band_keys(signature)):
+            candidates.update(self._members(band.get(key)))
+        candidates.discard(exclude_id)
+        if not candidates:
+            return []
+        candidate_ids = list(candidates)
+        matrix = np.stack([self._signatures[music_id] for music_id in candidate_ids])
+
+        similarities = (matrix == signature).mean(axis=1)
+        matches = [(music_id, float(similarity))
+                   for music_id, similarity in zip(candidate_ids, similarities) if similarity >= threshold]
+        return sorted(matches, key=lambda item: item[1], reverse=True)
+
+    def reserve(self, token, fingerprint, threshold, filename):
+        """
+        查询近似重复，并在同一把锁内将该指纹登记为“上传中”。
+        上传结束后必须调用 release。返回值同 query。
+        """
+        if fingerprint is None:
+            return []
+        self._ensure_built()
+        signature = _to_signature(fingerprint)
+        with self._lock:
+            matches = self._query_locked(signature, threshold)
+            self._add_locked(token, signature)
+            self._pending[token] = filename
+        return matches
+
+    def release(self, token, music_id=None):
+        """注销上传中的指纹；上传成功时传入 music_id，以该 ID 正式加入索引"""
+        with self._lock:
+            if token not in self._pending:
+                return
+            del self._pending[token]
+            signature = self._signatures[token]
+            self._remove_locked(token)
+            if music_id is not None:
+                self._remove_locked(music_id)
+                self._add_locked(music_id, signature)
+
+    def pending_filename(self, token):
+        with self._lock:
+            return self._pending.get(token)
+
+    def duplicate_groups(self, threshold):
+        """将互为近似重复的音乐合并为分组，返回 [[music_id, ...], ...]"""
+        self._ensure_built()
+        with self._lock:
+            buckets = []
+            for band in self._buckets:
+                for bucket in band.values():
+                    if not isinstance(bucket, set):
+                        continue
+                    stored_ids = [music_id for music_id in bucket if music_id not in self._pending]
+                    if len(stored_ids) > 1:
+                        buckets.append(stored_ids)
+            signatures = dict(self._signatures)
+
+        parent = {}
+
+        def find(x):
+            parent.setdefault(x, x)
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        # 只需比较落入同一 LSH 分段的音乐
+        checked = set()
+        for bucket in buckets:
+            matrix = np.stack([signatures[music_id] for music_id in bucket])
+            for i, music_id in enumerate(bucket[:-1]):
+                similarities = (matrix[i + 1:] == matrix[i]).mean(axis=1)
+                for other_id, similarity in zip(bucket[i + 1:], similarities):
+                    pair = (min(music_id, other_id), max(music_id, other_id))
+                    if pair in checked:
+                        continue
+                    checked.add(pair)
+                    if similarity >= threshold:
+                        root_a, root_b = find(music_id), find(other_id)
+                        if root_a != root_b:
+                            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+        groups = {}
+        for music_id in parent:
+            groups.setdefault(find(music_id), set()).add(music_id)
+        return [sorted(group) for group in groups.values() if len(group) > 1]
+
+
+fingerprint_index = FingerprintIndex()
+
+
+@click.command('fingerprint-backfill')
+@click.option('--all', 'recompute_all', is_flag=True, help='重新计算所有音乐的指纹（默认只处理缺少指纹的）')
+@click.option('--batch-size', default=50, show_default=True, help='每批提交的数量')
+@with_appcontext
+def fingerprint_backfill_command(recompute_all, batch_size):
+    """为已有的音乐文件批量计算音频指纹"""
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    query = Music.query.order_by(Music.id)
+    if not recompute_all:
+        query = query.filter(Music.fingerprint.is_(None))
+
+    music_ids = [music_id for (music_id,) in query.with_entities(Music.id).all()]
+    click.echo(f'共 {len(music_ids)} 首音乐需要计算指纹')
+
+    done = failed = 0
+    for start in range(0, len(music_ids), batch_size):
+        batch = Music.query.filter(Music.id.in_(music_ids[start:start + batch_size])).all()
+        for music in batch:
+            file_path = os.path.join(upload_folder, music.stored_name)
+            try:
+                with open(file_path, 'rb') as f:
+                    fingerprint = compute_fingerprint(f.read(), os.path.splitext(music.stored_name)[1])
+            except OSError as e:
+                current_app.logger.error(f"读取文件 {file_path} 失败: {str(e)}")
+                fingerprint = None
+
+            if fingerprint is None:
+                failed += 1
+                continue
+            music.fingerprint = fingerprint
+            done += 1
+        db.session.commit()
+        click.echo(f'进度: {min(start + batch_size, len(music_ids))}/{len(music_ids)}')
+
+    click.echo(f'完成：成功 {done} 首，失败 {failed} 首')
+    if recompute_all:
+        # 增量同步只能发现新增或删除的指纹，已有指纹被重新计算后需重启服务才能载入
+        click.echo('提示：运行中的服务需重启后才能载入重新计算的指纹')
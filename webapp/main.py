@@ -3,15 +3,20 @@ from flask import Blueprint, render_template, redirect, url_for, request, send_f
     current_app, jsonify, session
 from flask_login import login_required, current_user
 from .models import User, Music
-from .auth import ChangeUsernameForm, ChangePasswordForm
+from .auth import ChangeUsernameForm, ChangePasswordForm, is_setup_complete, invalidate_cached_user
 from .extensions import db, socketio
-import os, uuid, hashlib, io
+from .suggest import suggestion_index
+from .events import library_events, emit_upload_status, emit_upload_progress
+from .fingerprint import fingerprint_index, compute_fingerprint
+import os, uuid, hashlib, io, threading
 from mutagen.mp3 import MP3, HeaderNotFoundError
 from mutagen.flac import FLAC
 from pydub import AudioSegment
 from werkzeug.utils import secure_filename
-from sqlalchemy import or_, asc, desc
+from sqlalchemy import or_, asc, desc, func
+from sqlalchemy.exc import IntegrityError
 from unidecode import unidecode
+from flask_sqlalchemy.pagination import Pagination
 import re
 
 main_bp = Blueprint('main', __name__)
@@ -43,11 +48,30 @@ def _get_music_query(search_query='', sort_by='upload_time', order='desc', page=
             )
         )
 
-    return music_query.paginate(page=page, per_page=per_page, error_out=False)
+    return _WindowedPagination(query=music_query, page=page, per_page=per_page, error_out=False)
 
 
-def _process_flac_audio(file_content, original_name):
-    """处理高质量FLAC文件，进行标准化转换"""
+class _WindowedPagination(Pagination):
+    """
+    通过窗口函数在同一条查询中取回当前页数据和总数，省去单独的 COUNT 查询。
+    覆盖的是 Flask-SQLAlchemy 3.0/3.1 Pagination 的内部方法，requirements.txt 中已固定版本范围。
+    """
+
+    def _query_items(self):
+        query = self._query_args['query']
+        rows = query.add_columns(func.count().over()).limit(self.per_page).offset(self._query_offset).all()
+        self._window_total = rows[0][1] if rows else None
+        return [row[0] for row in rows]
+
+    def _query_count(self):
+        if self._window_total is not None:
+            return self._window_total
+        # 当前页没有数据（如页码越界）时才单独计数
+        return self._query_args['query'].order_by(None).count()
+
+
+def _process_flac_audio(file_content, original_name, on_stage=None):
+    """处理高质量FLAC文件，进行标准化转换，仅在确实需要转换时报告 normalizing 阶段"""
     if not current_app.config.get('FLAC_ENABLE_NORMALIZATION', False):
         # 如果在配置中禁用了，则直接返回原始内容
         return file_content, False
@@ -62,6 +86,8 @@ def _process_flac_audio(file_content, original_name):
         audio_info = FLAC(io.BytesIO(file_content))
 
         if audio_info.info.bits_per_sample > target_bits or audio_info.info.sample_rate > target_rate:
+            if on_stage:
+                on_stage('normalizing')
             sound = AudioSegment.from_file(io.BytesIO(file_content), format="flac")
 
             standard_sound = sound.set_sample_width(target_width).set_frame_rate(target_rate)
@@ -102,9 +128,12 @@ def _get_sorting_and_search_params():
     order = order_raw if order_raw in valid_order else 'desc'
     file_type = type_raw if type_raw in valid_types else 'all'
 
-    session['sort_by'] = sort_by
-    session['order'] = order
-    session['file_type'] = file_type
+    # 仅在取值变化时写入 session，避免每次请求都重新签发 cookie
+    for key, value, default in (('sort_by', sort_by, 'upload_time'),
+                                ('order', order, 'desc'),
+                                ('file_type', file_type, 'all')):
+        if session.get(key, default) != value:
+            session[key] = value
 
     search_query = request.args.get('q', '')
 
@@ -131,11 +160,11 @@ def _validate_upload_file(original_name_full):
     return display_name, filename_lower, None
 
 
-def _process_audio(file_content, filename_lower, original_name_full):
-    """处理音频内容（FLAC转换、读取时长、计算MD5）"""
+def _process_audio(file_content, filename_lower, original_name_full, on_stage=None):
+    """处理音频内容（FLAC转换、读取时长、计算MD5），on_stage 用于报告处理阶段"""
     is_converted = False
     if filename_lower.endswith('.flac'):
-        processed_content, is_converted = _process_flac_audio(file_content, original_name_full)
+        processed_content, is_converted = _process_flac_audio(file_content, original_name_full, on_stage)
         if processed_content is None:
             return None, None, None, False, f"处理FLAC文件 {original_name_full} 失败，已跳过"
         file_content = processed_content
@@ -152,6 +181,8 @@ def _process_audio(file_content, filename_lower, original_name_full):
         current_app.logger.error(f"文件可能已损坏 {original_name_full}: {str(e)}")
         return None, None, None, False, f'文件可能已损坏，已跳过：{original_name_full}'
 
+    if on_stage:
+        on_stage('hashing')
     file_hash = hashlib.md5(file_content).hexdigest()
     return file_content, duration, file_hash, is_converted, None
 
@@ -175,80 +206,248 @@ def _create_music_record(display_name, safe_name, unique_name, file_hash, durati
     return music
 
 
-def _process_uploaded_file_task(app, file_content, original_name_full, user_id):
+class _InflightUpload:
+    """正在后台处理中的上传任务，供内容相同的后续任务等待其结果"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.music_id = None
+
+
+# 以原始文件内容的MD5为键，记录正在处理中的上传任务
+_inflight_uploads = {}
+_inflight_lock = threading.Lock()
+
+# 等待相同内容的上传任务完成的最长时间（秒），超时后由等待的任务接管处理
+INFLIGHT_WAIT_TIMEOUT = 600
+
+
+def _claim_inflight_upload(content_hash, stale_entry=None):
+    """
+    登记一个正在处理的上传任务。
+    返回 (entry, is_owner)：若已有相同内容的任务在处理，is_owner 为 False。
+    stale_entry 为等待超时的任务时，将其替换为本任务。
+    """
+    with _inflight_lock:
+        entry = _inflight_uploads.get(content_hash)
+        if entry is not None and entry is not stale_entry:
+            return entry, False
+        entry = _InflightUpload()
+        _inflight_uploads[content_hash] = entry
+        return entry, True
+
+
+def _release_inflight_upload(content_hash, entry):
+    """注销上传任务并唤醒所有等待该结果的任务"""
+    with _inflight_lock:
+        if _inflight_uploads.get(content_hash) is entry:
+            del _inflight_uploads[content_hash]
+    entry.done.set()
+
+
+def _emit_duplicate_status(existing_music, original_name_full, user_id):
+    """通知上传者文件重复"""
+    current_app.logger.info(f"后台跳过重复文件: {original_name_full} (冲突ID: {existing_music.id})")
+    emit_upload_status(
+        user_id,
+        f'文件已存在！数据库中已有名为 "{existing_music.original_name}" (ID: {existing_music.id}) 的相同文件。',
+        'danger'
+    )
+
+
+def _process_uploaded_file_task(app, file_content, original_name_full, user_id, upload_id):
     """
     在后台线程中处理上传的文件。
     需要传入 app 对象来创建数据库和应用上下文。
+    相同内容的并发上传只会处理一次，后到的任务等待并复用先到任务的结果。
     """
     with app.app_context():
+        raw_hash = hashlib.md5(file_content).hexdigest()
+
+        stale_entry = None
+        while True:
+            entry, is_owner = _claim_inflight_upload(raw_hash, stale_entry)
+            if is_owner:
+                break
+
+            # 已有相同内容的任务在处理中，等待其结果
+            if not entry.done.wait(INFLIGHT_WAIT_TIMEOUT):
+                stale_entry = entry
+                continue
+            stale_entry = None
+            if entry.music_id is not None:
+                existing_music = db.session.get(Music, entry.music_id)
+                if existing_music:
+                    _emit_duplicate_status(existing_music, original_name_full, user_id)
+                    emit_upload_progress(user_id, [
+                        {'upload_id': upload_id, 'filename': original_name_full, 'stage': 'duplicate'}
+                    ])
+                    return
+            # 先到的任务失败或未保存，重新尝试由本任务处理
+
         try:
-            upload_folder = current_app.config['UPLOAD_FOLDER']
+            entry.music_id = _store_uploaded_file(file_content, original_name_full, user_id, upload_id)
+        finally:
+            # 上传失败或被跳过时注销登记的指纹（成功时已以 Music ID 正式入索引）
+            fingerprint_index.release(upload_id)
+            _release_inflight_upload(raw_hash, entry)
 
-            # 验证文件名
-            display_name, filename_lower, error_msg = _validate_upload_file(original_name_full)
-            if error_msg:
-                raise ValueError(error_msg)  # 抛出异常由 try/except 捕获
 
-            # 处理音频 (FLAC转换, MD5, 时长)
-            file_content, duration, file_hash, is_converted, error_msg = _process_audio(
-                file_content, filename_lower, original_name_full
-            )
-            if error_msg:
-                raise ValueError(error_msg)
+def _store_uploaded_file(file_content, original_name_full, user_id, upload_id):
+    """
+    处理、保存上传的文件并写入数据库。
+    成功保存或数据库中已有内容相同的文件时返回其 Music ID，否则返回 None。
+    """
+    def report_stage(stage):
+        emit_upload_progress(user_id, [{'upload_id': upload_id, 'filename': original_name_full, 'stage': stage}])
+
+    save_path = None
+    try:
+        upload_folder = current_app.config['UPLOAD_FOLDER']
+
+        # 验证文件名
+        display_name, filename_lower, error_msg = _validate_upload_file(original_name_full)
+        if error_msg:
+            raise ValueError(error_msg)  # 抛出异常由 try/except 捕获
 
-            # 检查MD5是否重复
+        # 处理音频 (FLAC转换, MD5, 时长)
+        file_content, duration, file_hash, is_converted, error_msg = _process_audio(
+            file_content, filename_lower, original_name_full, on_stage=report_stage
+        )
+        if error_msg:
+            raise ValueError(error_msg)
+
+        # 检查MD5是否重复
+        existing_music = Music.query.filter_by(md5_hash=file_hash).first()
+        if existing_music:
+            _emit_duplicate_status(existing_music, original_name_full, user_id)
+            report_stage('duplicate')
+            return existing_music.id
+
+        file_ext = os.path.splitext(filename_lower)[1]
+
+        # 计算音频指纹，检查不同格式/标签的同一首歌
+        fingerprint = None
+        near_duplicate = None
+        if current_app.config.get('FINGERPRINT_ENABLED', False):
+            report_stage('fingerprinting')
+            fingerprint = compute_fingerprint(file_content, file_ext)
+            near_duplicate = _find_near_duplicate(fingerprint, upload_id, original_name_full)
+            if near_duplicate and current_app.config.get('FINGERPRINT_REJECT_NEAR_DUPLICATES', False):
+                similar_name, similar_id, similarity = near_duplicate
+                current_app.logger.info(f"后台跳过近似重复文件: {original_name_full} (冲突: {similar_name})")
+                emit_upload_status(
+                    user_id,
+                    f'文件 {original_name_full} 与{_describe_near_duplicate(similar_name, similar_id)}'
+                    f'疑似为同一首歌（相似度 {similarity:.0%}），已跳过。',
+                    'danger'
+                )
+                report_stage('duplicate')
+                # 近似重复并非内容相同，不能作为等待中的相同内容任务的结果
+                return None
+
+        # 保存文件
+        safe_name = secure_filename(original_name_full)
+        unique_name = f"{uuid.uuid4()}{file_ext}"
+        save_path = os.path.join(upload_folder, unique_name)
+
+        with open(save_path, 'wb') as f:
+            f.write(file_content)
+
+        # 创建数据库记录
+        music = _create_music_record(
+            display_name, safe_name, unique_name, file_hash, duration, user_id
+        )
+        music.fingerprint = fingerprint
+        db.session.add(music)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # 检查与写入之间有其他任务写入了相同内容（例如不同原始文件转换后结果相同）
+            db.session.rollback()
+            _remove_file_quietly(save_path)
             existing_music = Music.query.filter_by(md5_hash=file_hash).first()
-            if existing_music:
-                current_app.logger.info(f"后台跳过重复文件: {original_name_full} (冲突ID: {existing_music.id})")
-                socketio.emit('upload_status', {
-                    'message': f'文件已存在！数据库中已有名为 "{existing_music.original_name}" (ID: {existing_music.id}) 的相同文件。',
-                    'category': 'danger'
-                })
-                return
-
-            # 保存文件
-            safe_name = secure_filename(original_name_full)
-            file_ext = os.path.splitext(filename_lower)[1]
-            unique_name = f"{uuid.uuid4()}{file_ext}"
-            save_path = os.path.join(upload_folder, unique_name)
-
-            with open(save_path, 'wb') as f:
-                f.write(file_content)
-
-            # 创建数据库记录
-            music = _create_music_record(
-                display_name, safe_name, unique_name, file_hash, duration, user_id
+            if not existing_music:
+                raise
+            _emit_duplicate_status(existing_music, original_name_full, user_id)
+            report_stage('duplicate')
+            return existing_music.id
+        save_path = None  # 记录已提交，文件不再需要清理
+        suggestion_index.add(music)
+        fingerprint_index.release(upload_id, music.id)
+
+        # 通知上传者，曲库变更合并后广播给所有客户端
+        report_stage('saved')
+        if near_duplicate:
+            similar_name, similar_id, similarity = near_duplicate
+            emit_upload_status(
+                user_id,
+                f'文件 {original_name_full} 已成功上传，但与{_describe_near_duplicate(similar_name, similar_id)}'
+                f'疑似重复（相似度 {similarity:.0%}）。',
+                'success'
             )
-            db.session.add(music)
-            db.session.commit()
+        else:
+            emit_upload_status(user_id, f'文件 {original_name_full} 已成功上传！', 'success')
+        library_events.music_added(music.id)
+        return music.id
+
+    except Exception as e:
+        db.session.rollback()
+        if save_path:
+            _remove_file_quietly(save_path)
+        current_app.logger.error(f"后台处理文件 {original_name_full} 失败: {str(e)}")
+        report_stage('failed')
+        emit_upload_status(user_id, f'文件 {original_name_full} 处理失败: {str(e)}', 'danger')
+        return None
 
-            # 通知所有客户端
-            socketio.emit('music_added', {'new_ids': [music.id]})
-            socketio.emit('upload_status', {
-                'message': f'文件 {original_name_full} 已成功上传！',
-                'category': 'success'
-            })
 
-        except Exception as e:
-            db.session.rollback()
-            current_app.logger.error(f"后台处理文件 {original_name_full} 失败: {str(e)}")
-            socketio.emit('upload_status', {
-                'message': f'文件 {original_name_full} 处理失败: {str(e)}',
-                'category': 'danger'
-            })
+def _find_near_duplicate(fingerprint, upload_id, original_name_full):
+    """
+    按音频指纹查找最相似的已有或正在上传的音乐，返回 (名称, Music ID 或 None, 相似度) 或 None。
+    查询的同时登记本次上传的指纹，使同批上传的同一首歌（如 MP3 与 FLAC）能互相发现。
+    """
+    threshold = current_app.config.get('NEAR_DUPLICATE_THRESHOLD', 0.25)
+    fingerprint_index.sync()
+    for key, similarity in fingerprint_index.reserve(upload_id, fingerprint, threshold, original_name_full):
+        if not isinstance(key, int):
+            # 上传标识：另一个正在处理的上传任务
+            pending_name = fingerprint_index.pending_filename(key)
+            if pending_name:
+                return pending_name, None, similarity
+            continue
+        similar_music = db.session.get(Music, key)
+        if similar_music:
+            return similar_music.original_name, similar_music.id, similarity
+    return None
+
+
+def _describe_near_duplicate(similar_name, similar_id):
+    """近似重复提示中对另一首音乐的描述"""
+    if similar_id is None:
+        return f'正在上传的 "{similar_name}" '
+    return f'已有的 "{similar_name}" (ID: {similar_id}) '
+
+
+def _remove_file_quietly(file_path):
+    """删除已写入的文件，忽略文件不存在等错误"""
+    try:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    except OSError as e:
+        current_app.logger.error(f"清理文件 {file_path} 失败: {str(e)}")
 
 
 # --- 路由和视图函数 ---
 @main_bp.route('/')
 def root():
-    if not User.query.first():
+    if not is_setup_complete():
         return redirect(url_for('auth.setup'))
     return redirect(url_for('main.index'))
 
 
 @main_bp.route('/index/')
 def index():
-    if not User.query.first():
+    if not is_setup_complete():
         return redirect(url_for('auth.setup'))
     if current_user.is_authenticated:
         return redirect(url_for('main.admin'))
@@ -271,6 +470,17 @@ def index():
                            sort_by=sort_by, order=order, file_type=file_type)
 
 
+MAX_SUGGESTIONS = 10
+
+
+@main_bp.route('/suggest')
+def suggest():
+    """搜索框输入提示，直接查询内存索引"""
+    prefix = request.args.get('q', '')[:MAX_FILENAME_LENGTH]
+    limit = min(max(request.args.get('limit', MAX_SUGGESTIONS, type=int), 1), MAX_SUGGESTIONS)
+    return jsonify({'suggestions': suggestion_index.suggest(prefix, limit)})
+
+
 @main_bp.route('/upload', methods=['POST'])
 @login_required
 def upload():
@@ -292,8 +502,10 @@ def upload():
     real_app = current_app._get_current_object()
 
     files_submitted_count = 0
+    pending_tasks = []
 
     try:
+        user_id = current_user.id
         for file in files:
             if file.filename == '':
                 continue
@@ -301,22 +513,31 @@ def upload():
             # 在请求上下文中快速完成 I/O 和数据准备
             original_name_full = file.filename
             file_content = file.read()
-            user_id = current_user.id
+            upload_id = uuid.uuid4().hex
+            pending_tasks.append((file_content, original_name_full, upload_id))
 
+        if not pending_tasks:
+            response_messages.append({'message': '未选择任何有效文件。', 'category': 'danger'})
+            return jsonify({'success': False, 'messages': response_messages})
+
+        # 整批文件只推送一次“已接收”，且先于后台任务的任何进度
+        emit_upload_progress(user_id, [
+            {'upload_id': upload_id, 'filename': original_name_full, 'stage': 'received'}
+            for _, original_name_full, upload_id in pending_tasks
+        ])
+
+        for file_content, original_name_full, upload_id in pending_tasks:
             # 将所有耗时任务交给后台线程
             socketio.start_background_task(
                 _process_uploaded_file_task,
                 real_app,  # 传入 app 对象
                 file_content,  # 传入文件内容
                 original_name_full,  # 传入文件名
-                user_id  # 传入用户 ID
+                user_id,  # 传入用户 ID
+                upload_id  # 传入本次上传的进度标识
             )
             files_submitted_count += 1
 
-        if files_submitted_count == 0:
-            response_messages.append({'message': '未选择任何有效文件。', 'category': 'danger'})
-            return jsonify({'success': False, 'messages': response_messages})
-
     except Exception as e:
         # 这个 catch 块只捕获提交任务之前的错误 (例如 file.read() 失败)
         current_app.logger.error(f'提交上传任务时发生严重错误: {str(e)}')
@@ -373,6 +594,8 @@ def delete_batch_music():
 
                 db.session.delete(music)
                 db.session.commit()
+                suggestion_index.remove(music_id)
+                fingerprint_index.remove(music_id)
                 deleted_ids.append(music_id)
             except Exception as e:
                 db.session.rollback()
@@ -382,10 +605,7 @@ def delete_batch_music():
     total_music_count_after = total_music_count_before - len(deleted_ids)
 
     if deleted_ids:
-        socketio.emit('remove_music_items_batch', {
-            'music_ids': deleted_ids,
-            'total_music_count_after': total_music_count_after
-        })
+        library_events.music_removed(deleted_ids)
 
     total_pages_after = max(1, (total_music_count_after + per_page - 1) // per_page)
     redirect_page = min(current_page, total_pages_after)
@@ -446,13 +666,42 @@ def admin():
                            active_tab=active_tab)
 
 
+@main_bp.route('/admin/duplicates')
+@login_required
+def duplicates():
+    if not current_user.is_admin:
+        abort(403)
+
+    threshold = current_app.config.get('NEAR_DUPLICATE_THRESHOLD', 0.25)
+    # 载入其他进程（如补全命令）写入的指纹
+    fingerprint_index.sync()
+    id_groups = fingerprint_index.duplicate_groups(threshold)
+
+    music_by_id = {}
+    all_ids = [music_id for group in id_groups for music_id in group]
+    if all_ids:
+        music_by_id = {music.id: music for music in Music.query.filter(Music.id.in_(all_ids)).all()}
+
+    groups = []
+    for group in id_groups:
+        members = [music_by_id[music_id] for music_id in group if music_id in music_by_id]
+        if len(members) > 1:
+            groups.append(members)
+
+    missing_count = Music.query.filter(Music.fingerprint.is_(None)).count()
+    return render_template('duplicates.html', groups=groups, threshold=threshold, missing_count=missing_count)
+
+
 @main_bp.route('/admin/change-username', methods=['POST'])
 @login_required
 def change_username():
     form = ChangeUsernameForm()
     if form.validate_on_submit():
-        current_user.username = form.new_username.data
+        # current_user 可能是已脱离会话的缓存对象，需重新查询后再修改
+        user = db.session.get(User, current_user.id)
+        user.username = form.new_username.data
         db.session.commit()
+        invalidate_cached_user(user.id)
         return jsonify({'success': True, 'messages': [{'message': '用户名已成功修改！', 'category': 'success'}]})
     else:
         messages = [{'message': error, 'category': 'danger'} for errors in form.errors.values() for error in errors]
@@ -464,13 +713,14 @@ def change_username():
 def change_password():
     form = ChangePasswordForm()
     if form.validate_on_submit():
-        user = current_user
+        user = db.session.get(User, current_user.id)
         if user.check_password(form.new_password.data):
             return jsonify(
                 {'success': False, 'messages': [{'message': '新密码不能与当前密码相同。', 'category': 'danger'}]})
 
         user.set_password(form.new_password.data)
         db.session.commit()
+        invalidate_cached_user(user.id)
         return jsonify({'success': True, 'messages': [{'message': '密码已成功修改！', 'category': 'success'}]})
 
     else:
@@ -1,6 +1,7 @@
 # webapp/models.py
 from .extensions import db
 from flask_login import UserMixin
+from sqlalchemy.orm import deferred
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 import pytz
@@ -30,6 +31,8 @@ class Music(db.Model):
     duration = db.Column(db.Integer)
     upload_time = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    # 音频指纹仅在去重时使用，延迟加载以免拖慢列表查询
+    fingerprint = deferred(db.Column(db.LargeBinary, nullable=True))
 
     @property
     def local_upload_time(self):
@@ -48,3 +51,12 @@ class LoginAttempt(db.Model):
     ip_address = db.Column(db.String(100), unique=True, nullable=False)
     attempts = db.Column(db.Integer, default=0)
     lockout_until = db.Column(db.DateTime(timezone=True), nullable=True)
+
+
+def upgrade_schema():
+    """为旧数据库补充后续新增的列（db.create_all 不会修改已存在的表）"""
+    columns = {column['name'] for column in db.inspect(db.engine).get_columns('music')}
+    if 'fingerprint' not in columns:
+        column_type = db.LargeBinary().compile(dialect=db.engine.dialect)
+        with db.engine.begin() as conn:
+            conn.execute(db.text(f'ALTER TABLE music ADD COLUMN fingerprint {column_type}'))
@@ -2,11 +2,44 @@
 
 let isUploading = false;
 let selectedMusicIds = new Set();
+const uploadProgress = new Map();
+
+const UPLOAD_STAGE_LABELS = {
+    received: '已接收',
+    normalizing: '正在标准化',
+    hashing: '正在校验',
+    fingerprinting: '正在计算指纹',
+    saved: '已保存'
+};
+const UPLOAD_FINAL_STAGES = ['saved', 'duplicate', 'failed'];
 
 document.addEventListener('DOMContentLoaded', () => {
     initAdminInteractions();
 });
 
+document.addEventListener('uploadProgress', (event) => {
+    event.detail.items.forEach(item => {
+        if (UPLOAD_FINAL_STAGES.includes(item.stage)) {
+            uploadProgress.delete(item.upload_id);
+        } else {
+            uploadProgress.set(item.upload_id, item);
+        }
+    });
+    renderUploadProgress();
+});
+
+function renderUploadProgress() {
+    const progressEl = document.getElementById('upload-progress');
+    if (!progressEl) return;
+    progressEl.innerHTML = '';
+    uploadProgress.forEach(item => {
+        const line = document.createElement('div');
+        line.className = 'text-truncate';
+        line.textContent = `${UPLOAD_STAGE_LABELS[item.stage] || item.stage}：${item.filename}`;
+        progressEl.appendChild(line);
+    });
+}
+
 function initAdminInteractions() {
     const musicListContainer = document.getElementById('music-list-container');
     if (musicListContainer) {
@@ -114,6 +114,10 @@ document.addEventListener('DOMContentLoaded', () => {
             }
         });
 
+        socket.on('upload_progress', (data) => {
+            document.dispatchEvent(new CustomEvent('uploadProgress', { detail: data }));
+        });
+
         socket.on('remove_music_items_batch', (data) => {
             const PER_PAGE = 20;
             const currentUrl = new URL(window.location);
@@ -142,11 +146,38 @@ document.addEventListener('DOMContentLoaded', () => {
                     const submitEvent = new Event('submit', { bubbles: true, cancelable: true });
                     searchForm.dispatchEvent(submitEvent);
                 }
+            } else if (searchInput) {
+                requestSuggestions(searchInput.value);
             }
         });
     }
 });
 
+let suggestTimeout;
+
+function requestSuggestions(query) {
+    clearTimeout(suggestTimeout);
+    suggestTimeout = setTimeout(() => {
+        fetch(`/suggest?q=${encodeURIComponent(query)}`)
+            .then(response => response.ok ? response.json() : Promise.reject('Network error'))
+            .then(data => {
+                const datalist = document.getElementById('search-suggestions');
+                if (!datalist) return;
+                datalist.innerHTML = '';
+                data.suggestions.forEach(item => {
+                    const option = document.createElement('option');
+                    option.value = item.name;
+                    // 浏览器只显示 value 或 label 中包含输入内容的选项，用罗马音/首字母输入时需带上命中的索引词
+                    if (item.key && !item.name.toLowerCase().includes(item.key)) {
+                        option.label = `${item.name} (${item.key})`;
+                    }
+                    datalist.appendChild(option);
+                });
+            })
+            .catch(error => console.error('Error fetching suggestions:', error));
+    }, 150);
+}
+
 function handleListInteraction(event) {
     const isSocketTrigger = event && event.isSocketTrigger;
     const targetPage = event && event.page;
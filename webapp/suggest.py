@@ -0,0 +1,104 @@
+# webapp/suggest.py
+from bisect import bisect_left, insort
+import threading
+import re
+
+from .models import Music
+
+
+class SuggestionIndex:
+    """
+    基于有序数组的内存前缀索引，用于搜索框的输入提示。
+    索引 original_name、romanized_name（整体及每个单词）和 romanized_initials，
+    查询时无需访问数据库。
+    """
+
+    def __init__(self):
+        self._keys = []      # 有序的 (key, music_id) 列表
+        self._items = {}     # music_id -> (original_name, [key, ...])
+        self._lock = threading.Lock()
+        self._built = False
+
+    @staticmethod
+    def _make_keys(music):
+        keys = set()
+        for value in (music.original_name, music.romanized_name, music.romanized_initials):
+            if value:
+                keys.add(value.strip().lower())
+        if music.romanized_name:
+            # 让用户从歌名中间的单词开始输入也能命中
+            for word in re.findall(r'\w+', music.romanized_name.lower()):
+                keys.add(word)
+        keys.discard('')
+        return sorted(keys)
+
+    def rebuild(self):
+        """从数据库全量重建索引（需要应用上下文）"""
+        rows = Music.query.with_entities(
+            Music.id, Music.original_name, Music.romanized_name, Music.romanized_initials
+        ).all()
+
+        keys = []
+        items = {}
+        for row in rows:
+            row_keys = self._make_keys(row)
+            items[row.id] = (row.original_name, row_keys)
+            keys.extend((key, row.id) for key in row_keys)
+        keys.sort()
+
+        with self._lock:
+            self._keys = keys
+            self._items = items
+            self._built = True
+
+    def add(self, music):
+        """增量加入一首音乐"""
+        row_keys = self._make_keys(music)
+        with self._lock:
+            if music.id in self._items:
+                self._remove_locked(music.id)
+            self._items[music.id] = (music.original_name, row_keys)
+            for key in row_keys:
+                insort(self._keys, (key, music.id))
+
+    def remove(self, music_id):
+        """增量移除一首音乐"""
+        with self._lock:
+            self._remove_locked(music_id)
+
+    def _remove_locked(self, music_id):
+        item = self._items.pop(music_id, None)
+        if not item:
+            return
+        for key in item[1]:
+            pos = bisect_left(self._keys, (key, music_id))
+            if pos < len(self._keys) and self._keys[pos] == (key, music_id):
+                del self._keys[pos]
+
+    def suggest(self, prefix, limit=10):
+        """
+        返回前缀匹配的前 limit 条结果: [{'id': ..., 'name': ..., 'key': ...}]
+        key 为命中的索引词（如罗马音或首字母），前端用作选项标签，使浏览器不会把它过滤掉。
+        """
+        prefix = prefix.strip().lower()
+        if not prefix or limit <= 0:
+            return []
+        if not self._built:
+            self.rebuild()
+
+        results = []
+        seen = set()
+        with self._lock:
+            pos = bisect_left(self._keys, (prefix,))
+            while pos < len(self._keys) and len(results) < limit:
+                key, music_id = self._keys[pos]
+                if not key.startswith(prefix):
+                    break
+                if music_id not in seen:
+                    seen.add(music_id)
+                    results.append({'id': music_id, 'name': self._items[music_id][0], 'key': key})
+                pos += 1
+        return results
+
+
+suggestion_index = SuggestionIndex()